@@ -1,23 +1,39 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+import numpy as np
 from langchain_core.documents import Document
+
+log = logging.getLogger(__name__)
+
 class ContextService():
-	def __init__(self,compressor,rewriter_model,reRanker_client):
+	RERANK_CACHE_SIZE = 1024 # number of (query, docs, k) rerank results kept in memory
+	LOCAL_RERANK_MAX_DOCS = 20 # above this many chunks the local cross encoder is too slow, cohere is used instead
+	
+	def __init__(self,compressor,rewriter_model,reRanker_client,local_reRanker=None,skip_rerank_if_k_le=0):
 		""" Args:
 			chunks: list of reranked chunks returned be vectorservice search.
 			query: query is the user query
+			local_reRanker: optional sentence_transformers CrossEncoder used instead of the cohere api for small chunk lists
+			skip_rerank_if_k_le: when k is at most this value the chunks are kept in the faiss order without reranking
 		"""
 		self.compressor = compressor
 		self.reRanker_client = reRanker_client 
+		self.local_reRanker = local_reRanker
+		self.skip_rerank_if_k_le = skip_rerank_if_k_le
 		self.rewriter_model = rewriter_model
+		self._rerank_cache = OrderedDict() # least recently used cache of (query, doc hashes, k) -> reranked indices
 		
-	def build_query(self,query):
+	async def build_query(self,query):
 		""" builds the query returned by vector service
 			Returns: str -> rewritten query which is used by vector service"""
-		rewritten_query = self.rewriter_model.invoke(query)
-		print(f"rewritten_query is {rewritten_query} ")
+		rewritten_query = await self.rewriter_model.ainvoke(query)
+		log.debug("rewritten_query is %s ", rewritten_query)
 		return rewritten_query
 		
-	def reRanker(self,rewritten_query:str, chunks_list: list,k:int):
-		""" Receives the chunks_list retrieved by from database and reranks them on the basis of relevence using api call from cohere.
+	async def reRanker(self,rewritten_query:str, chunks_list: list,k:int):
+		""" Receives the chunks_list retrieved by from database and reranks them on the basis of relevence using the local cross encoder or api call from cohere.
 		Args: 
 			list-> list of retrived chunks as langchain document from the vector database
 			rewritten_query:str: rewritten_ query from the rewritter
@@ -25,21 +41,62 @@ class ContextService():
 		Returns:
 			list -> list of reranked chunks with their ids.
 		"""
-		# chunks_list contanins the text in metadata['content']
+		indices = await self._rerank_indices(rewritten_query, chunks_list, k)
+		return [chunks_list[index] for index in indices]  # rearranging the chunks
+		
+	async def _rerank_indices(self,rewritten_query:str, chunks_list: list,k:int):
+		""" Returns: list -> positions in chunks_list of the top k chunks, most relevant first """
+		if k <= self.skip_rerank_if_k_le:
+			return list(range(min(k, len(chunks_list))))   # for tiny k reranking rarely changes the order, faiss similarity order is kept
+			
+		# chunks_list contanins the text in metadata['content'], extracted once for the cache key, the local scores and the cohere request
 		docs = [item['metadata']['content'] for item in chunks_list]
-		response = self.reRanker_client.rerank(
-			model='rerank-v3.5',
-			query=rewritten_query,
-			documents=docs,
-			top_n=k)
+		key = (rewritten_query, tuple(hashlib.blake2b(doc.encode(), digest_size=16).digest() for doc in docs), k)
+		indices = self._rerank_cache.get(key)
+		if indices is not None:
+			self._rerank_cache.move_to_end(key)   # repeated query over the same chunks, no api call
+			return indices
 			
-		indices = [item.index for item in response.results]   # contains the indices in order returned by reranker
-		results = []
-		for index in indices:
-			results.append(chunks_list[index])  # rearranging the chunks
-		return results
+		if self.local_reRanker is not None and len(chunks_list) <= self.LOCAL_RERANK_MAX_DOCS:
+			# scoring locally avoids the https round trip to cohere
+			scores = await asyncio.to_thread(self.local_reRanker.predict, [(rewritten_query, doc) for doc in docs])
+			indices = np.argsort(-np.asarray(scores))[:k].tolist()   # highest score first
+		else:
+			response = await self.reRanker_client.rerank(   # reRanker_client is a cohere.AsyncClientV2
+				model='rerank-v3.5',
+				query=rewritten_query,
+				documents=docs,   # must be a list, the sdk re-sends the same request body when it retries
+				top_n=k)
+				
+			indices = [item.index for item in response.results]   # contains the indices in order returned by reranker
+		self._rerank_cache[key] = indices
+		if len(self._rerank_cache) > self.RERANK_CACHE_SIZE:
+			self._rerank_cache.popitem(last=False)
+		return indices
+		
+	async def rerank_and_compress(self,rewritten_query:str, chunks_list: list,k:int):
+		""" Reranks the chunks and compresses them at the same time, the compressor works on the retrieved order
+		and its output is put back into the reranked order once both are done.
+		Args:
+			rewritten_query:str: rewritten_ query from the rewritter
+			chunks_list: list of retrived chunks from the vector database
+			k: number of top we need 
+		Returns:
+			tuple -> (list of reranked chunks, str concatenated string from compressed chunks in reranked order)
+		"""
+		indices, compressed_docs = await asyncio.gather(
+			self._rerank_indices(rewritten_query, chunks_list, k),
+			self._compress_documents(chunks_list, rewritten_query))
 			
-	def chunk_compressor(self,chunks,query):
+		rank = {index: position for position, index in enumerate(indices)}
+		# chunks dropped by the reranker are dropped from the context too
+		ranked_docs = sorted(
+			(doc for doc in compressed_docs if doc.metadata["chunk_index"] in rank),
+			key=lambda doc: rank[doc.metadata["chunk_index"]])
+		context = "\n\n".join(d.page_content for d in ranked_docs)
+		return [chunks_list[index] for index in indices], context
+		
+	async def chunk_compressor(self,chunks,query):
 		""" takes the chunk and query and compress it buy removing umwanted and irrelevant chunks
 			Args:  
 				list: list of chunks
@@ -47,26 +104,22 @@ class ContextService():
 			Returns:
 				str: concatenated string from compressed chunks
 		"""
-		""" the content should never be list it must always be list we need to hard normalise it before passing it to LLMLinguaCompressor"""
-		docs = []
-		for chunk in chunks:
-			content = chunk["metadata"]["content"]
-			
-			# if the content is list -> convert to string 
-			if isinstance(content,list):
-				content=" ".join(content)
-			elif not isinstance(content,str):
-				content=str(content)
-			docs.append(
-				Document(
-					page_content=content,
-					metadata=chunk["metadata"]
-				)
-			)
-		compressed_docs = self.compressor.compress_documents(
+		compressed_docs = await self._compress_documents(chunks, query)
+		return "\n\n".join(d.page_content for d in compressed_docs)
+		
+	async def _compress_documents(self,chunks,query):
+		""" Returns: list -> compressed langchain documents, metadata["chunk_index"] is the position of the source chunk in chunks """
+		# content is normalised to str once at ingest by VectorService, so no per chunk type checks here
+		# only the chunk position is needed back from the compressor, the chunk metadata is not copied into each document
+		docs = [
+			Document(page_content=chunk["metadata"]["content"], metadata={"chunk_index": i})
+			for i, chunk in enumerate(chunks)
+		]    # passes chunks must be in langchain document format
+		# LLMLingua runs locally and is blocking, so it is pushed to a worker thread to keep the event loop free
+		return await asyncio.to_thread(
+			self.compressor.compress_documents,
 			documents=docs,
 			query=query
 			)
-		return "\n\n".join(d.page_content for d in compressed_docs)
 		
 		
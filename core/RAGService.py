@@ -1,48 +1,68 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
 class RAGService:
     def __init__(self, vector_service, context_service, llm):
         self.vector_service = vector_service
         self.context_service = context_service
         self.llm = llm
 
-    def answer(self, query: str):
+    async def answer(self, query: str):
         """
         RAG main function generates response by orchestrating
         vector_service, context_service, and the main LLM.
         """
 
-        # Rewrite query
-        rewritten_query = self.context_service.build_query(query)
-        print(f"Rewritten length: {len(rewritten_query)}")
-        print(f"User query rewritten as: {rewritten_query}")
+        # Rewrite query, searching with the raw query at the same time as a fallback
+        rewritten_query, raw_chunks = await asyncio.gather(
+            self.context_service.build_query(query),
+            asyncio.to_thread(self.vector_service.search, query, k=3),
+            return_exceptions=True
+        )
+        if isinstance(raw_chunks, BaseException):
+            raise raw_chunks
+        # search returns {"error": ...} instead of chunks while the index is empty, e.g. the first document is still being ingested
+        if isinstance(raw_chunks, dict):
+            return raw_chunks["error"]
 
         # Retrieve chunks
-        retrieved_chunks = self.vector_service.search(rewritten_query, k=3)
+        if isinstance(rewritten_query, BaseException) or not rewritten_query:
+            log.warning("Query rewrite failed (%s), using the original query", rewritten_query)
+            rewritten_query = query
+            retrieved_chunks = raw_chunks
+        elif rewritten_query.strip() == query:
+            retrieved_chunks = raw_chunks
+        else:
+            log.debug("Rewritten length: %d", len(rewritten_query))
+            log.debug("User query rewritten as: %s", rewritten_query)
+            retrieved_chunks = await asyncio.to_thread(self.vector_service.search, rewritten_query, k=3)
+            if isinstance(retrieved_chunks, dict):
+                return retrieved_chunks["error"]
 
-        print("\n==============RETRIEVED CHUNKS=====================\n\n")
-        for i, chunk in enumerate(retrieved_chunks):
-            print(f"{i}:\n\n{chunk['metadata']['content']}\n")
+        # chunk contents can be many KB, only format them when debug logging is on
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("\n==============RETRIEVED CHUNKS=====================\n\n")
+            for i, chunk in enumerate(retrieved_chunks):
+                log.debug(f"{i}:\n\n{chunk['metadata']['content']}\n")
 
-        # Rerank chunks
+        # Rerank chunks and consolidate / compress context concurrently
         num_chunks = len(retrieved_chunks)
-        reranked_chunks = self.context_service.reRanker(
+        reranked_chunks, context = await self.context_service.rerank_and_compress(
             rewritten_query,
             retrieved_chunks,
             num_chunks
         )
 
-        print("\n================RERANKED CHUNKS=================\n\n")
-        for i, chunk in enumerate(reranked_chunks):
-            print(f"{i} : \n\n{chunk['metadata']['content']}\n")
-
-        # Consolidate / compress context
-        print(type(reranked_chunks[0]))
-        context = self.context_service.chunk_compressor(
-            reranked_chunks,
-            rewritten_query
-        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("\n================RERANKED CHUNKS=================\n\n")
+            for i, chunk in enumerate(reranked_chunks):
+                log.debug(f"{i} : \n\n{chunk['metadata']['content']}\n")
 
-        print("\n\n=========BUILDED CONTEXT===========================\n\n")
-        print(f"{context}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"\n\n=========BUILDED CONTEXT===========================\n\n{context}")
 
         # Final response generation
         prompt = f"""
@@ -55,5 +75,5 @@ Question:
 {rewritten_query}
 """
 
-        return self.llm.invoke(prompt)
+        return await self.llm.ainvoke(prompt)
 
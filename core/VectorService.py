@@ -1,65 +1,183 @@
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import hashlib
 import faiss
 import pickle
+import torch
 from pypdf import PdfReader
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
 from langchain_core.documents import Document   #Document object have two components, page_content(str) and metadata(dictionary)
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import ipc
 
 class VectorService():
 	""" Main class does all the work required for loading the text from documents , 
 	chunking it , making embeddings, storing them , storing the index into disk,
 	searching using query."""
 	
+	# columns of the chunk store, one row per chunk in the same order as the vectors in the index
+	CHUNK_SCHEMA = pa.schema([
+		("source", pa.string()),
+		("page_number", pa.int32()),
+		("content", pa.large_string())])
+	EMBEDDINGS_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+	ONNX_CPU_MODEL_FILE = 'onnx/model_qint8_avx512_vnni.onnx' # int8 onnx export shipped in the model repo, uses vnni dot products on cpu
+	EMB_CACHE_SIZE = 20000 # embeddings kept by the least recently used cache, about 30 MB of float32 vectors
+	ENCODE_BATCH_SIZE = 64 # number of chunks encoded together in one forward pass
+	CHUNK_OVERLAP_TOKENS = 32 # tokens shared by consecutive chunks
+	HNSW_EF_CONSTRUCTION = 200 # candidate list size while building the graph, higher gives a better graph
+	HNSW_EF_SEARCH = 64 # candidate list size while searching, plenty for k=3
+	PAGES_QUEUE_SIZE = 32 # extracted pages waiting to be split and encoded
+	
 	def __init__(self,data_path):
 		""" initialises the model, makes the path for persistence storage,
 		loads the data if exists already.
 		
 		Args:
-			data_path(str): path to store persistent data files(index, metadata,content)
+			data_path(str): path to store persistent data files(index, chunks, embedding cache)
 		"""
 		
 		self.index_path = os.path.join(data_path,'index.faiss')
-		self.meta_path = os.path.join(data_path,'metadata.pkl')
+		self.chunks_dir = os.path.join(data_path,'chunks') # one arrow file per ingested document, appended never rewritten
+		self.meta_path = os.path.join(data_path,'metadata.pkl') # legacy pickle stores, migrated into chunks_dir on load
 		self.content_path = os.path.join(data_path,'content.pkl')
 		os.makedirs(data_path,exist_ok=True)
+		os.makedirs(self.chunks_dir,exist_ok=True)
 		
 		# initalising the model 
 		print('Loading the Model')
-		self.embeddings_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+		self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+		if self.device == 'cuda':
+			self.embeddings_model = SentenceTransformer(self.EMBEDDINGS_MODEL_NAME, device=self.device)
+			self.embeddings_model.half() # fp16 weights on gpu halves the memory traffic of each batch
+		else:
+			# on cpu the matmuls are the bottleneck, the quantized onnx runtime model is 2-4x faster than fp32 torch
+			self.embeddings_model = SentenceTransformer(
+				self.EMBEDDINGS_MODEL_NAME,
+				device=self.device,
+				backend='onnx',
+				model_kwargs={"file_name": self.ONNX_CPU_MODEL_FILE})
 		print("Model Loaded")
+		# embeddings of another model or backend (fp16 torch, int8 onnx) differ, each one gets its own cache file
+		backend = 'torch_fp16' if self.device == 'cuda' else 'onnx_' + os.path.splitext(os.path.basename(self.ONNX_CPU_MODEL_FILE))[0]
+		self.emb_cache_path = os.path.join(data_path,f"emb_cache_{self.EMBEDDINGS_MODEL_NAME.split('/')[-1]}_{backend}.pkl")
 		self.embedding_dim = self.embeddings_model.get_sentence_embedding_dimension() # get the model embedding dimension used in storing the embeddings
 		
+		# chunks are measured with the model tokenizer so each one fits the model input, the [CLS] and [SEP] tokens take 2 of max_seq_length
+		# anything longer would be silently truncated by the model and the tail of the chunk never embedded
+		# the splitter gets its own tokenizer, the model one is not safe to share with queries encoding while a document is ingested
+		self.text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+			AutoTokenizer.from_pretrained(self.EMBEDDINGS_MODEL_NAME),
+			chunk_size=self.embeddings_model.max_seq_length - 2,
+			chunk_overlap=self.CHUNK_OVERLAP_TOKENS)
+		
 		# initialising attributes to hold the data in memory
 		self.index = None # index initialisiation will contain the vector index
-		self.metadata = [] # metadata array will contain the metadata of each chunk
-		self.content = [] # content array will contain the content i.e. text of each chunk
+		self.chunks = self.CHUNK_SCHEMA.empty_table() # memory mapped table with the metadata and content i.e. text of each chunk
+		self._index_lock = threading.Lock() # guards swapping self.index and self.chunks after an ingest while searches read them
+		self._ingest_lock = threading.Lock() # one ingest at a time, each one builds on the index file written by the previous one
+		self._emb_cache = OrderedDict() # least recently used cache from the hash of a chunk text to its embedding, reused across documents
+		self._emb_cache_unsaved = {} # cache entries not yet appended to the cache file
+		self._emb_cache_file_entries = 0 # entries in the cache file, it is compacted once it holds twice EMB_CACHE_SIZE
+		self._emb_cache_lock = threading.Lock()
 		self._load_data() #calling the load data method (helper method) will load the index, metadata,content from memory if already exists
 	def _load_data(self):
-		""" Load the index, metadata, content from memory if does already exists"""
+		""" Load the index, chunks, embedding cache from memory if does already exists"""
 		if os.path.exists(self.index_path):
 			print("\nLoading FAISS index")
-			self.index = faiss.read_index(self.index_path)
+			self.index = self._read_index()
 		else:
 			print("\nNo FAISS index found intialising a new one")
-			self._initialise_empty_index()
-		if os.path.exists(self.meta_path):
-			with open(self.meta_path, 'rb') as f_meta:
-				self.metadata = pickle.load(f_meta)
-		else:
-			self.metadata = []
-		if os.path.exists(self.content_path):
-			with open(self.content_path,'rb') as f_content:
-				self.content = pickle.load(f_content)
-		else:
-			self.content = []
+			self.index = self._initialise_empty_index()
+		if not self._chunk_files() and os.path.exists(self.meta_path) and os.path.exists(self.content_path):
+			self._migrate_pickle_data()
+		# memory mapping only reads the pages a search touches, loading is independent of the corpus size
+		tables = [ipc.open_file(pa.memory_map(path)).read_all() for path in self._chunk_files()]
+		self.chunks = pa.concat_tables(tables) if tables else self.CHUNK_SCHEMA.empty_table()
+		self._emb_cache = OrderedDict()
+		self._emb_cache_file_entries = 0
+		if os.path.exists(self.emb_cache_path):
+			# the cache file is a sequence of pickled dicts, one appended per ingest, oldest first
+			with open(self.emb_cache_path,'rb') as f_cache:
+				while True:
+					try:
+						entries = pickle.load(f_cache)
+					except EOFError:
+						break
+					self._emb_cache_file_entries += len(entries)
+					for key, embedding in entries.items():
+						self._emb_cache[key] = embedding
+						self._emb_cache.move_to_end(key)
+			while len(self._emb_cache) > self.EMB_CACHE_SIZE:
+				self._emb_cache.popitem(last=False)
 		print("\nData loaded successfully")
 			
 				
+	def _read_index(self):
+		""" memory maps the index read only, workers of several processes share the same pages of the os page cache """
+		# IO_FLAG_MMAP_IFC maps the stored codes and graph of non ivf indexes like hnsw, IO_FLAG_MMAP alone only maps ivf lists
+		index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP_IFC)
+		index.hnsw.efSearch = self.HNSW_EF_SEARCH
+		return index
+		
+	def _chunk_files(self):
+		""" paths of the arrow chunk files in the order they were written """
+		names = sorted((name for name in os.listdir(self.chunks_dir) if name.endswith('.arrow')), key=lambda name: int(name.split('.')[0]))
+		return [os.path.join(self.chunks_dir, name) for name in names]
+		
+	def _migrate_pickle_data(self):
+		""" writes the metadata and content of the old pickle stores as the first arrow chunk file """
+		print("\nMigrating pickled metadata and content to arrow")
+		with open(self.meta_path, 'rb') as f_meta:
+			metadata = pickle.load(f_meta)
+		with open(self.content_path,'rb') as f_content:
+			content = pickle.load(f_content)
+		self._write_chunks(self._chunks_table(metadata, [self._normalise_content(text) for text in content]))
+		
+	@staticmethod
+	def _normalise_content(content) -> str:
+		""" the content stored for a chunk must always be a string, a list is joined and anything else converted """
+		if isinstance(content, str):
+			return content
+		if isinstance(content, list):
+			return " ".join(content)
+		return str(content)
+		
+	def _chunks_table(self, chunk_metadata: list, chunk_text: list):
+		""" builds a table in CHUNK_SCHEMA from the metadata and text of each chunk """
+		return pa.table({
+			"source": [meta["source"] for meta in chunk_metadata],
+			"page_number": [meta["page_number"] for meta in chunk_metadata],
+			"content": chunk_text}, schema=self.CHUNK_SCHEMA)
+			
+	def _write_chunks(self, table):
+		""" writes the rows of table as a new arrow file after the existing ones """
+		path = os.path.join(self.chunks_dir, f"{len(self._chunk_files())}.arrow")
+		with ipc.new_file(path, self.CHUNK_SCHEMA) as writer:
+			writer.write_table(table)
+		return path
+		
 	def _initialise_empty_index(self):
-		"""Initialises a empty FAISS index using HNSW algorithm."""
-		self.index = faiss.IndexHNSWFlat(self.embedding_dim,32,faiss.METRIC_INNER_PRODUCT) # METRIC_INNER_PRODCUT calculates the dot product and when normalised gives the cosine simlilarity
+		"""Initialises a empty FAISS index using HNSW algorithm over 8 bit scalar quantized vectors.
+		Returns:
+			faiss.IndexHNSWSQ: the new trained and empty index
+		"""
+		# QT_8bit stores each dimension in one byte instead of a float32, 4x less memory read per distance computation
+		# METRIC_INNER_PRODCUT calculates the dot product and when normalised gives the cosine simlilarity
+		index = faiss.IndexHNSWSQ(self.embedding_dim,faiss.ScalarQuantizer.QT_8bit,32,faiss.METRIC_INNER_PRODUCT)
+		index.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION
+		index.hnsw.efSearch = self.HNSW_EF_SEARCH
+		# embeddings are L2 normalised so every dimension lies in [-1, 1], the quantizer is trained on that fixed range
+		# rather than on the first document, whose ranges would clip the vectors of every later document
+		index.train(np.vstack([-np.ones(self.embedding_dim), np.ones(self.embedding_dim)]).astype('float32'))
+		return index
 		
 	def process_store_pdf(self, pdf_file_path: str, filename: str):
 			""" Loads and process the pdf given by chunking it, embedding it and storing the embeddings into vector store
@@ -71,49 +189,175 @@ class VectorService():
 			RAISES:
 				ValueError: If the file is already processed or no text can be extracted from the given file.
 			"""
-			if any(meta.get('source')== filename for meta in self.metadata):
+			if pc.any(pc.equal(self.chunks['source'], filename)).as_py():
 				raise ValueError(f"file: {filename} is already processed. Try another file")
 				
-			all_pages = []
 			try:
 				reader = PdfReader(os.path.join(pdf_file_path,filename))
-				for i, page in enumerate(reader.pages):
-					text= page.extract_text()   # extract the text from each page
-					all_pages.append(Document(
-						page_content=text,
-						metadata={"source": filename, "page_number": i+1}))  # adds the page_content i.e. text and metadata i.e. the source and the page number to the all_pages
-				if not all_pages:   #if no text is extracted i.e. all_pages list is empty
+				if not reader.pages:   #if the pdf has no pages there is no text to extract
 					raise ValueError(f"No text could be extracted from file: {filename}") 
 			except Exception as e:
 				raise RuntimeError(f"Error opening the pdf error:{e}")
 			
 			
-			text_splitter = RecursiveCharacterTextSplitter(chunk_size = 1000, chunk_overlap=200)
-			chunks = text_splitter.split_documents(all_pages) #split_documents is used rather than split_text, it preserves the document type of all_pages , so chunks have text and metadata both
+			# pipeline: a worker thread extracts the pages while this thread splits and encodes the pages already extracted
+			pages_queue = queue.Queue(maxsize=self.PAGES_QUEUE_SIZE)
+			stop = threading.Event()   # tells the extraction thread to give up if encoding fails
+			chunk_text = []  # contains text from each chunk
+			chunk_metadata = []   # contains metadata from each chunk
+			embeddings = []   # normalised embeddings of each encoded batch of chunks
+			encoded = 0   # number of chunks in chunk_text already encoded
+			with ThreadPoolExecutor(max_workers=1) as executor:
+				extraction = executor.submit(self._extract_pages, reader, filename, pages_queue, stop)
+				try:
+					while (page := pages_queue.get()) is not None:
+						chunks = self.text_splitter.split_documents([page]) #split_documents is used rather than split_text, it preserves the document type of the page , so chunks have text and metadata both
+						chunk_text.extend(self._normalise_content(chunk.page_content) for chunk in chunks)
+						chunk_metadata.extend(chunk.metadata for chunk in chunks)
+						
+						# making embeddings of each full batch of chunks
+						while len(chunk_text) - encoded >= self.ENCODE_BATCH_SIZE:
+							embeddings.append(self._encode_with_cache(chunk_text[encoded:encoded + self.ENCODE_BATCH_SIZE]))
+							encoded += self.ENCODE_BATCH_SIZE
+				finally:
+					stop.set()
+				try:
+					extraction.result()
+				except Exception as e:
+					raise RuntimeError(f"Error opening the pdf error:{e}")
+					
+			if not chunk_text:   # scanned or image only pages extract no text, nothing must reach the index
+				raise ValueError(f"No text could be extracted from file: {filename}")
+				
+			embeddings.append(self._encode_with_cache(chunk_text[encoded:]))  # last partial batch
+			embeddings_np = np.concatenate(embeddings).astype('float32', copy=False) # faiss only takes numpy array and float32 
 			
-			chunk_text = [chunk.page_content for chunk in chunks]  # contains text from each chunk
-			chunk_metadata = [chunk.metadata for chunk in chunks]   # contains metadata from each chunk
+			with self._ingest_lock:
+				if pc.any(pc.equal(self.chunks['source'], filename)).as_py():   # same file ingested by another thread meanwhile
+					raise ValueError(f"file: {filename} is already processed. Try another file")
+					
+				# the memory mapped index is read only, the vectors are added to a separate in memory copy
+				# searches keep using self.index until _save_data swaps in the new one
+				index = faiss.read_index(self.index_path) if os.path.exists(self.index_path) else self._initialise_empty_index()
+				index.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION   # indexes written before it was set still carry the faiss default
+				
+				# saving the embeddings into index
+				index.add(embeddings_np)
+				
+				self._save_data(index, self._chunks_table(chunk_metadata, chunk_text)) # saves the data into disk
+			print("File saved successfully")
 			
-			# making embeddings of each chunk 
-			embeddings = self.embeddings_model.encode(chunk_text)  # encoding the chunks into embeddings
-			embeddings_np = np.array(embeddings).astype('float32') # faiss only takes numpy array and float32 
-			faiss.normalize_L2(embeddings_np) # this normalizes the embeddigns which is required for cosine similarity search
+	@staticmethod
+	def _extract_pages(reader, filename: str, pages_queue, stop):
+		""" Producer of the ingest pipeline, puts one Document per page of the pdf into pages_queue, then None once done
+		Args:
+			reader(PdfReader): reader of the pdf being processed
+			filename(str): name of the file being processed
+			pages_queue(queue.Queue): queue consumed by process_store_pdf
+			stop(threading.Event): set by the consumer when it stops reading the queue
+		"""
+		def put(item):
+			while not stop.is_set():
+				try:
+					pages_queue.put(item, timeout=0.1)
+					return
+				except queue.Full:
+					continue
+					
+		try:
+			for i, page in enumerate(reader.pages):
+				if stop.is_set():   # encoding failed, the remaining pages are not needed
+					break
+				text= page.extract_text()   # extract the text from each page
+				put(Document(
+					page_content=text,
+					metadata={"source": filename, "page_number": i+1}))  # the page_content i.e. text and metadata i.e. the source and the page number
+		finally:
+			put(None)
 			
-			# saving the embeddings into index
-			self.index.add(embeddings_np)
-			self.metadata.extend(chunk_metadata)  # appends each element of chunk_metadata to the end of metadata list
-			self.content.extend(chunk_text) 
+	@staticmethod
+	def _chunk_hash(text: str) -> bytes:
+		""" key of a chunk text in the embedding cache """
+		return hashlib.blake2b(text.encode(), digest_size=16).digest()
+		
+	def _encode_with_cache(self, chunk_text: list):
+		""" Encodes only the chunks whose text is not already in the embedding cache (boilerplate, headers repeated across documents)
+		Args:
+			chunk_text(list): text of each chunk
+		Returns:
+			np.ndarray: embeddings matrix in the same order as chunk_text
+		"""
+		keys = [self._chunk_hash(text) for text in chunk_text]
+		if not keys:
+			return np.empty((0, self.embedding_dim), dtype='float32')
 			
-			self._save_data() # saves the data into disk
-			print("File saved successfully")
+		# unique misses only, a text repeated inside the same document is encoded once
+		found = {}
+		to_encode = {}
+		with self._emb_cache_lock:
+			for key, text in zip(keys, chunk_text):
+				if key in self._emb_cache:
+					found[key] = self._emb_cache[key]
+					self._emb_cache.move_to_end(key)
+				elif key not in to_encode:
+					to_encode[key] = text
+					
+		if to_encode:
+			new_embeddings = dict(zip(to_encode.keys(), np.asarray(self._encode_chunks(list(to_encode.values())), dtype='float32')))
+			found.update(new_embeddings)
+			with self._emb_cache_lock:
+				self._emb_cache.update(new_embeddings)
+				self._emb_cache_unsaved.update(new_embeddings)
+				while len(self._emb_cache) > self.EMB_CACHE_SIZE:
+					self._emb_cache.popitem(last=False)
+					
+		return np.stack([found[key] for key in keys])
+		
+	def _encode_chunks(self, chunk_text: list):
+		""" Encodes the chunk text in batches into L2 normalised embeddings (required for cosine similarity search)
+		Args:
+			chunk_text(list): text of each chunk
+		Returns:
+			np.ndarray: embeddings matrix of shape (len(chunk_text), embedding_dim)
+		"""
+		return self.embeddings_model.encode(
+			chunk_text,
+			batch_size=self.ENCODE_BATCH_SIZE,
+			convert_to_numpy=True,
+			normalize_embeddings=True,
+			show_progress_bar=False)
 			
-	def _save_data(self):
-		""" saves the index , content, metadata into the disk"""
-		faiss.write_index(self.index, self.index_path)
-		with open(self.content_path, 'wb') as f_content:
-			pickle.dump(self.content, f_content)
-		with open(self.meta_path, 'wb') as f_meta:
-			pickle.dump(self.metadata, f_meta)				
+	def _save_data(self, index, new_chunks):
+		""" saves the index , the new chunks and the new embedding cache entries into the disk, then makes them visible to searches
+		Args:
+			index(faiss.Index): in memory index with the vectors of the new chunks added
+			new_chunks(pa.Table): rows of the chunks just added to the index, only these are written
+		"""
+		# the hnsw graph has no incremental on disk format, the index is the only file rewritten in full
+		# written next to the old file and swapped in, processes that have the old file memory mapped keep reading it safely
+		tmp_index_path = self.index_path + '.tmp'
+		faiss.write_index(index, tmp_index_path)
+		os.replace(tmp_index_path, self.index_path)
+		mapped_index = self._read_index()   # drops the in memory copy used for the ingest
+		path = self._write_chunks(new_chunks)
+		chunks = pa.concat_tables([self.chunks, ipc.open_file(pa.memory_map(path)).read_all()])
+		with self._index_lock:   # searches only wait for the swap, not for the add and the writes above
+			self.index = mapped_index
+			self.chunks = chunks
+		with self._emb_cache_lock:
+			unsaved = {key: embedding for key, embedding in self._emb_cache_unsaved.items() if key in self._emb_cache}   # evicted entries are not kept
+			self._emb_cache_unsaved = {}
+			if self._emb_cache_file_entries + len(unsaved) > 2 * self.EMB_CACHE_SIZE:
+				# compaction: the file is rewritten with only the entries still cached, keeping its size and the load time bounded
+				tmp_cache_path = self.emb_cache_path + '.tmp'
+				with open(tmp_cache_path, 'wb') as f_cache:
+					pickle.dump(dict(self._emb_cache), f_cache)
+				os.replace(tmp_cache_path, self.emb_cache_path)
+				self._emb_cache_file_entries = len(self._emb_cache)
+			elif unsaved:
+				with open(self.emb_cache_path, 'ab') as f_cache:
+					pickle.dump(unsaved, f_cache)
+				self._emb_cache_file_entries += len(unsaved)				
 		
 	def search (self, query:str, k:int):
 		""" Semantically searches the index using the query provided by the user
@@ -127,26 +371,21 @@ class VectorService():
 			return {"error": "The index is empty please upload a document first"}
 		
 		# query into vectors
-		embeddings_query = self.embeddings_model.encode(query)
-		embeddings_query_np = np.array(([embeddings_query]), dtype='float32')
-		faiss.normalize_L2(embeddings_query_np)
-		
-		# searching the faiss index
-		distances, indices = self.index.search(embeddings_query_np, k) # returns the distances and the indices of the k most similar searches, returns a 2D matrix (for each query ,but we have only one query)
-		# for cosine similarity the greater the distance => more the similarity
-		
-		# fetching the chunk from the indices
-		results = []
-		for i,idx in enumerate(indices[0]):
-			if idx!=-1 and idx<len(self.metadata):
-				result_metadata = self.metadata[idx].copy()   # copying because changing result won't change the original metadata
-				result_metadata['content'] = self.content[idx]
-				results.append({
-					"metadata": result_metadata,
-					"similarity": float(distances[0][i])
-					})
-					
-					
+		embeddings_query = self.embeddings_model.encode(query, convert_to_numpy=True, normalize_embeddings=True)
+		embeddings_query_np = np.ascontiguousarray(embeddings_query[None, :], dtype=np.float32) # (1, d) view, copied only if not already float32
+		
+		with self._index_lock:
+			# searching the faiss index
+			distances, indices = self.index.search(embeddings_query_np, k) # returns the distances and the indices of the k most similar searches, returns a 2D matrix (for each query ,but we have only one query)
+			# for cosine similarity the greater the distance => more the similarity
+			
+			# fetching the chunks from the indices in one gather, only the selected rows are read from the memory map
+			found = (indices[0] != -1) & (indices[0] < self.chunks.num_rows)
+			rows = self.chunks.take(indices[0][found]).to_pylist()
+		results = [
+			{"metadata": row, "similarity": float(similarity)}
+			for row, similarity in zip(rows, distances[0][found])]
+			
 		return results
 	
 	
@@ -1,70 +1,97 @@
 import sys
+import asyncio
 import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from langchain_community.document_compressors import LLMLinguaCompressor
+from sentence_transformers import CrossEncoder
 from core.VectorService import VectorService
 from core.ContextService import ContextService
 from core.RAGService import RAGService
 from utils import SYSTEM_PROMPT, READER_PROMPT
 from models.llm import GeminiModel
 import cohere
+import httpx
 # loading dotenv
 load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))  # LOG_LEVEL=DEBUG shows the retrieved chunks and the built context
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
+# one pool of persistent http/2 connections for the gemini and cohere calls, repeated queries skip the tcp + tls handshakes
+httpx_client = httpx.AsyncClient(
+		http2=True,
+		limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60))
 rewriter_model = GeminiModel(
 			model_name="gemini-2.5-pro",
-			system_prompt=SYSTEM_PROMPT		
+			system_prompt=SYSTEM_PROMPT,
+			httpx_async_client=httpx_client
 		)
 reader_model = GeminiModel(
 			model_name="gemini-2.5-pro",
-			system_prompt=READER_PROMPT
+			system_prompt=READER_PROMPT,
+			httpx_async_client=httpx_client
 		)
-reRanker_client = cohere.ClientV2()
+reRanker_client = cohere.AsyncClientV2(httpx_client=httpx_client)
+# the local cross encoder is opt in with USE_LOCAL_RERANKER=1, by default reranking goes to cohere
+local_reRanker = CrossEncoder("BAAI/bge-reranker-base") if os.getenv("USE_LOCAL_RERANKER") == "1" else None
 compressor = LLMLinguaCompressor(
 		model_name="gpt2",
 		device_map="cpu")
 		
 data_path = "./data_store"
+def report_ingestion(ingestion):
+	""" prints the error of a background ingestion if it failed """
+	e = ingestion.exception()
+	if e is not None:
+		print(f"\nError during ingestion :{e}")
+		
 def main():
 	vector_service = VectorService(data_path)  #makes a directory named data_store
 	context_service = ContextService(
 			compressor=compressor,
 			rewriter_model=rewriter_model,
-			reRanker_client=reRanker_client)
+			reRanker_client=reRanker_client,
+			local_reRanker=local_reRanker)
 			
 	rag_service = RAGService(
 			vector_service=vector_service,
 			context_service=context_service,
 			llm=reader_model
 			)
-	while True:			
-		print("\nSelect an Option:")
-		print("\n1) Ingest Document(Build Embeddings)")
-		print("\n2) Ask question")
+	# documents are ingested one at a time on a background thread so questions can be asked while a large pdf is processed
+	ingest_executor = ThreadPoolExecutor(max_workers=1)
+	loop = asyncio.new_event_loop()  # one loop for the whole session so the async clients keep their connections
+	try:
+		while True:			
+			print("\nSelect an Option:")
+			print("\n1) Ingest Document(Build Embeddings)")
+			print("\n2) Ask question")
 		
-		choice = input("\nEnter choice 1 or 2\n").strip()
+			choice = input("\nEnter choice 1 or 2\n").strip()
 		
-		if choice== "1":
-			filepath = input("\nEnter filepath: ").strip()
-			filename = input("\nEnter filename: ").strip()
+			if choice== "1":
+				filepath = input("\nEnter filepath: ").strip()
+				filename = input("\nEnter filename: ").strip()
 			
-			try:
-				vector_service.process_store_pdf(pdf_file_path=filepath,filename=filename)
-			except Exception as e:
-				print(f"\nError during ingestion :{e}")
-		elif choice == "2":
-			query = input("\nEnter your query").strip()
+				ingestion = ingest_executor.submit(vector_service.process_store_pdf, pdf_file_path=filepath, filename=filename)
+				ingestion.add_done_callback(report_ingestion)
+				print(f"\nIngesting {filename} in the background")
+			elif choice == "2":
+				query = input("\nEnter your query").strip()
 			
-			try:
-				response=rag_service.answer(query)
-				print(response)
-			except Exception as e:
-				print(f"\nThere was problem answering your query: {e}")
-		else:
-			print("\nInvalid  choice")
-			sys.exit(1)
+				try:
+					response=loop.run_until_complete(rag_service.answer(query))
+					print(response)
+				except Exception as e:
+					print(f"\nThere was problem answering your query: {e}")
+			else:
+				print("\nInvalid  choice")
+				sys.exit(1)
+	finally:
+		loop.run_until_complete(httpx_client.aclose())  # closes the pooled connections shared by the gemini and cohere clients
+		loop.close()
 		
 if __name__ == "__main__":
 	main()			
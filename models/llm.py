@@ -2,10 +2,12 @@ from google import genai
 from google.genai import types
 
 class GeminiModel:
-    def __init__(self, model_name: str, system_prompt: str):
+    def __init__(self, model_name: str, system_prompt: str, httpx_async_client=None):
         # Ensure you have your API key set in your environment 
         # or pass it here: genai.Client(api_key="YOUR_KEY")
-        self.client = genai.Client()
+        # httpx_async_client lets ainvoke reuse a shared pool of keep-alive connections
+        http_options = types.HttpOptions(httpx_async_client=httpx_async_client) if httpx_async_client else None
+        self.client = genai.Client(http_options=http_options)
         self.model_name = model_name
         self.system_prompt = system_prompt
 
@@ -20,3 +22,16 @@ class GeminiModel:
             ),
         )
         return response.text
+
+    async def ainvoke(self, user_input: str, *, temperature=0.0, max_tokens=1024) -> str:
+        # async variant so the rewrite/answer calls can be awaited alongside other stages
+        response = await self.client.aio.models.generate_content(
+            model=self.model_name,
+            contents=user_input,
+            config=types.GenerateContentConfig(
+                system_instruction=self.system_prompt,
+                temperature=temperature,
+                max_output_tokens=max_tokens,
+            ),
+        )
+        return response.text